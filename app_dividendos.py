@@ -1,7 +1,15 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import hashlib
+import io
+import os
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 import yfinance as yf
 import pandas as pd
-import matplotlib.pyplot as plt
+import numpy as np
 from datetime import datetime, timedelta
 import google.generativeai as genai # Importar a biblioteca do Gemini
 
@@ -11,16 +19,40 @@ TICKER_IBOV = "^BVSP"
 # Período de análise (últimos 2 anos para um bom histórico)
 DIAS_HISTORICO = 730 # Aproximadamente 2 anos
 
+# Período de dividendos baixado (precisa cobrir o maior CAGR exibido, de 5 anos)
+ANOS_DIVIDENDOS = 5
+
+# Datas de referência calculadas uma única vez por execução.
+# HOJE fica à meia-noite para que as chaves do cache não mudem ao longo do dia.
+HOJE = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+UM_ANO_ATRAS = HOJE - timedelta(days=365)
+
+# Campos do .info usados pela aplicação
+CAMPOS_INFO = ('longName', 'sector', 'currentPrice', 'forwardPE', 'priceToBook', 'returnOnEquity', 'marketCap')
+
+# Cache em disco das respostas do Yahoo Finance (sobrevive a reinícios do Streamlit)
+CACHE_DIR = Path(".yf_cache")
+CACHE_TTL_INFO = timedelta(hours=6) # Preço atual e indicadores mudam ao longo do dia
+CACHE_TTL_HISTORICO = timedelta(hours=6) # Preços e dividendos do download em lote
+CACHE_TTL_HISTORICO_PARCIAL = timedelta(minutes=15) # Download com algum ticker sem dados: nova tentativa depois disso
+CACHE_IDADE_MAXIMA = timedelta(days=7) # Arquivos mais antigos que isso são apagados do disco
+CACHE_MAX_EXPORTS = 100 # Limite de gráficos/CSVs gerados guardados por função do st.cache_data
+CACHE_TTL_IA = timedelta(hours=24) # Mesmo prompt (mesma carteira no mesmo dia) reaproveita a análise da IA
+CACHE_MAX_RESPOSTAS_IA = 50 # Limite de respostas da IA guardadas em memória (as mais antigas saem primeiro)
+
 # --- Configurar a API do Gemini (Lê a chave das secrets do Streamlit) ---
-try:
+# st.cache_resource mantém o mesmo cliente entre as reexecuções do script (cada clique em um widget)
+@st.cache_resource
+def carregar_modelo_ia():
     genai.configure(api_key=st.secrets["GEMINI_API_KEY"])
+    return genai.GenerativeModel('gemini-1.5-flash')
+
+try:
+    model = carregar_modelo_ia() # Inicializa o modelo da IA
 except AttributeError:
     st.error("Chave de API do Gemini não configurada. Por favor, adicione 'GEMINI_API_KEY' nas Secrets do Streamlit Cloud.")
     st.stop() # Interrompe a execução se a chave não estiver configurada
 
-# Inicializa o modelo da IA
-model = genai.GenerativeModel('gemini-1.5-flash')
-
 # --- Inicialização do Session State ---
 if 'ia_report_text' not in st.session_state:
     st.session_state.ia_report_text = None
@@ -39,35 +71,45 @@ st.info("Por favor, faça o upload de um arquivo CSV ou Excel com as colunas 'Ti
 
 uploaded_file = st.file_uploader("Escolha um arquivo CSV ou Excel", type=["csv", "xlsx"])
 
+def _coluna_usada(coluna):
+    # Filtro do usecols: só as colunas usadas são lidas do arquivo
+    return coluna in ('Ticker', 'Peso')
+
 CARTEIRA_ACOES = {} # Inicializa como vazio
 if uploaded_file is not None:
     try:
+        # Lê só as colunas usadas (as demais nem são convertidas) e o Ticker sempre como texto.
+        # O Peso é convertido depois com pd.to_numeric, para que valores inválidos virem aviso e não erro de leitura.
         if uploaded_file.name.endswith('.csv'):
-            df_upload = pd.read_csv(uploaded_file)
+            df_upload = pd.read_csv(uploaded_file, usecols=_coluna_usada, dtype={'Ticker': str})
         else: # Assumir .xlsx
-            df_upload = pd.read_excel(uploaded_file)
+            df_upload = pd.read_excel(uploaded_file, usecols=_coluna_usada, dtype={'Ticker': str})
         
         # Validar colunas
         if 'Ticker' in df_upload.columns and 'Peso' in df_upload.columns:
-            total_pesos = 0
-            for index, row in df_upload.iterrows():
-                ticker = str(row['Ticker']).strip().upper()
-                try:
-                    peso = float(row['Peso'])
-                    if peso > 0:
-                        CARTEIRA_ACOES[ticker] = {"peso": peso} # Nome e setor serão buscados dinamicamente
-                        total_pesos += peso
-                    else:
-                        st.warning(f"Ignorando ticker '{ticker}': Peso deve ser maior que zero.")
-                except ValueError:
-                    st.warning(f"Ignorando ticker '{ticker}': Peso inválido. Certifique-se de que é um número.")
+            # Limpeza vetorizada das colunas (sem percorrer linha a linha)
+            df_upload['Ticker'] = df_upload['Ticker'].astype(str).str.strip().str.upper()
+            df_upload['Peso'] = pd.to_numeric(df_upload['Peso'], errors='coerce') # Pesos não numéricos viram NaN
+
+            # Um único aviso listando todos os tickers ignorados
+            mask_invalido = df_upload['Peso'].isna() | (df_upload['Peso'] <= 0)
+            if mask_invalido.any():
+                tickers_invalidos = ", ".join(df_upload.loc[mask_invalido, 'Ticker'])
+                st.warning(f"Ignorando tickers com peso inválido (o peso deve ser um número maior que zero): {tickers_invalidos}")
+
+            # Se um ticker aparecer mais de uma vez, vale a última linha
+            df_validos = df_upload.loc[~mask_invalido].drop_duplicates(subset='Ticker', keep='last')
+            pesos = df_validos['Peso']
+            total_pesos = pesos.sum()
             
             # Normalizar pesos se a soma não for 1.0 (100%) e houver ações
             if total_pesos > 0 and abs(total_pesos - 1.0) > 0.01:
                 st.warning(f"A soma dos pesos é {total_pesos:.2f}. Normalizando os pesos para 100%.")
-                for ticker in CARTEIRA_ACOES:
-                    CARTEIRA_ACOES[ticker]["peso"] /= total_pesos
-            elif total_pesos == 0 and len(CARTEIRA_ACOES) > 0: # Caso todos os pesos sejam 0, mas há tickers
+                pesos = pesos / total_pesos
+
+            CARTEIRA_ACOES = {ticker: {"peso": float(peso)} for ticker, peso in zip(df_validos['Ticker'], pesos)} # Nome e setor serão buscados dinamicamente
+
+            if total_pesos == 0 and len(CARTEIRA_ACOES) > 0: # Caso todos os pesos sejam 0, mas há tickers
                 st.error("Nenhuma ação com peso válido foi encontrada no arquivo. Certifique-se de que os pesos são números maiores que zero.")
                 CARTEIRA_ACOES = {} # Limpa a carteira para evitar processamento com erro
         else:
@@ -85,85 +127,245 @@ if not CARTEIRA_ACOES: # Se a carteira ainda estiver vazia após o upload
     st.stop() # Interrompe a execução se não houver carteira válida
 
 
+# --- Funções de cache em disco ---
+def _arquivo_cache(namespace, chave):
+    return CACHE_DIR / namespace / f"{hashlib.md5(chave.encode()).hexdigest()}.pkl"
+
+def ler_cache_disco(namespace, chave, ttl):
+    # Retorna None se não houver entrada válida (inexistente, expirada ou corrompida)
+    arquivo = _arquivo_cache(namespace, chave)
+    try:
+        if datetime.now().timestamp() - arquivo.stat().st_mtime > ttl.total_seconds():
+            return None
+    except OSError:
+        return None # Ainda não existe no cache
+
+    try:
+        with open(arquivo, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        # Arquivo corrompido ou gravado com outra versão do pandas/numpy (AttributeError, ModuleNotFoundError, ...):
+        # apaga para que a próxima busca regrave a entrada
+        try:
+            arquivo.unlink()
+        except OSError:
+            pass
+        return None
+
+def salvar_cache_disco(namespace, chave, valor):
+    arquivo = _arquivo_cache(namespace, chave)
+    try:
+        arquivo.parent.mkdir(parents=True, exist_ok=True)
+        # Grava em arquivo temporário e renomeia, para que threads concorrentes nunca leiam um arquivo pela metade
+        temporario = arquivo.with_suffix(f".{os.getpid()}.{id(valor)}.tmp")
+        with open(temporario, 'wb') as f:
+            pickle.dump(valor, f)
+        os.replace(temporario, arquivo)
+    except OSError:
+        pass # O cache em disco é só uma otimização; sem ele os dados são buscados normalmente
+
+# st.cache_resource evita que a limpeza rode a cada reexecução; o ttl faz com que ela
+# volte a rodar uma vez por dia em um servidor que fica muito tempo no ar
+@st.cache_resource(ttl=timedelta(days=1))
+def limpar_cache_disco(idade_maxima=CACHE_IDADE_MAXIMA):
+    # As chaves incluem a data, então entradas de dias anteriores nunca mais são lidas
+    limite = datetime.now().timestamp() - idade_maxima.total_seconds()
+    for arquivo in CACHE_DIR.glob("*/*"):
+        try:
+            if arquivo.stat().st_mtime < limite:
+                arquivo.unlink()
+        except OSError:
+            pass
+
+limpar_cache_disco()
+
 # --- Função para buscar dados de ações ---
+@st.cache_data(ttl=timedelta(hours=6), show_spinner=False) # Roda em threads; o spinner da seção já cobre a espera
+def buscar_dados_acao(ticker, hoje=HOJE):
+    # 'hoje' entra na chave do cache: as entradas de um dia nunca são servidas no dia seguinte
+    chave = f"{ticker}|{hoje:%Y%m%d}"
+
+    info = ler_cache_disco("info", chave, CACHE_TTL_INFO)
+    if info is None:
+        # Guarda só os campos usados: o .info completo tem centenas de chaves e seria serializado a cada acesso ao cache
+        info_completo = yf.Ticker(ticker).info
+        info = {campo: info_completo[campo] for campo in CAMPOS_INFO if campo in info_completo}
+        salvar_cache_disco("info", chave, info)
+
+    return info
+
+# --- Função auxiliar para buscar os dados de um ticker em uma thread ---
+def buscar_dados_ticker(ticker):
+    # Captura o erro aqui para que uma ação com problema não interrompa as demais
+    try:
+        return ticker, (buscar_dados_acao(ticker, hoje=HOJE), None)
+    except Exception as e:
+        return ticker, (None, e)
+
+# --- Função para buscar preços e dividendos de todos os tickers de uma vez ---
+class HistoricoIncompleto(Exception):
+    # Lançada quando algum ticker falhou no download: o st.cache_data não guarda exceções,
+    # então o resultado parcial não fica preso por 6 horas no cache de resultados completos
+    def __init__(self, tickers_com_falha, historico):
+        super().__init__(f"sem dados para {', '.join(tickers_com_falha)}")
+        self.tickers_com_falha = tickers_com_falha
+        self.historico = historico
+
+# O yf.download guarda o estado em variáveis globais do módulo (yf.shared._DFS e _ERRORS):
+# duas sessões baixando carteiras diferentes ao mesmo tempo misturariam os resultados
+@st.cache_resource
+def trava_yf_download():
+    return threading.Lock()
+
+# Cache curto do download em si, inclusive de resultados parciais: um ticker inválido na carteira
+# não faz cada reexecução baixar de novo o histórico de todos os outros
+@st.cache_data(ttl=CACHE_TTL_HISTORICO_PARCIAL, show_spinner=False)
+def baixar_historico(tickers, hoje=HOJE):
+    inicio_precos = hoje - timedelta(days=DIAS_HISTORICO)
+    inicio_dividendos = hoje - timedelta(days=ANOS_DIVIDENDOS * 365)
+    # actions=True traz a coluna 'Dividends' na mesma resposta dos preços
+    # 'end' é exclusivo no yfinance: soma um dia para incluir o pregão de hoje
+    with trava_yf_download(): # Um download por vez no processo, lendo os erros antes que outro download os reinicie
+        dados = yf.download(list(tickers), start=min(inicio_precos, inicio_dividendos), end=hoje + timedelta(days=1),
+                            actions=True, group_by='ticker', threads=True, auto_adjust=True, progress=False)
+        # O yf.download não lança erro quando um ticker falha: registra em yf.shared._ERRORS e preenche com NaN
+        erros = set(yf.shared._ERRORS)
+
+    datas = dados.index.tz_localize(None) if dados.index.tz is not None else dados.index
+    # Colunas no formato (ticker, campo): preço de fechamento só do período de análise
+    # (float32 basta para gráficos e retornos: metade dos bytes no cache, na normalização e no produto matricial)
+    fechamentos = dados.xs('Close', level=1, axis=1)[datas >= inicio_precos].astype('float32')
+    # Dividendos: apenas as datas em que houve pagamento
+    # (um ticker que falhou no download pode vir sem a coluna 'Dividends')
+    todos_dividendos = dados.xs('Dividends', level=1, axis=1) if 'Dividends' in dados.columns.get_level_values(1) else pd.DataFrame()
+    dividendos = {t: todos_dividendos[t][todos_dividendos[t] > 0] for t in todos_dividendos.columns}
+
+    tickers_com_falha = [t for t in tickers if t in erros or t not in fechamentos.columns or not fechamentos[t].notna().any()]
+    return fechamentos, dividendos, tickers_com_falha
+
 @st.cache_data(ttl=timedelta(hours=6))
-def buscar_dados_acao(ticker):
-    acao = yf.Ticker(ticker)
-    info = acao.info
-    hoje = datetime.now()
-    inicio = hoje - timedelta(days=DIAS_HISTORICO)
-    hist = acao.history(start=inicio, end=hoje)
-    dividends = acao.dividends
-    return info, hist, dividends
+def buscar_historico_carteira(tickers, hoje=HOJE):
+    # Uma única chamada ao yf.download (com threads internas) em vez de um .history() e um .dividends por ticker
+    chave = f"{','.join(tickers)}|{hoje:%Y%m%d}"
+    historico = ler_cache_disco("historico", chave, CACHE_TTL_HISTORICO)
+    if historico is not None:
+        return historico
+
+    fechamentos, dividendos, tickers_com_falha = baixar_historico(tickers, hoje=hoje)
+    historico = (fechamentos, dividendos)
+    if tickers_com_falha:
+        # Fica só no cache curto do baixar_historico: depois dele o download é tentado de novo
+        raise HistoricoIncompleto(tickers_com_falha, historico)
+
+    salvar_cache_disco("historico", chave, historico)
+    return historico
+
+# --- Funções auxiliares de conversão/formatação de métricas ---
+def _numero(valor):
+    # Métricas do .info podem faltar ou vir como texto: vira NaN para a coluna continuar numérica
+    return float(valor) if isinstance(valor, (int, float)) else np.nan
+
+def _formatar(valor, modelo):
+    return "N/A" if pd.isna(valor) else modelo.format(valor)
 
 # --- Função para calcular o crescimento anual de dividendos (CAGR) ---
 def calcular_crescimento_dividendos(dividends_series, years):
+    # Retorna o CAGR em % (float) ou NaN quando não é possível calcular
     if dividends_series.empty or len(dividends_series) < 2:
-        return "N/A" # Não há dados suficientes para calcular crescimento
+        return np.nan # Não há dados suficientes para calcular crescimento
 
     # Certifique-se que o índice está como datetime e é tz-naive
     if dividends_series.index.tz is not None:
         dividends_series = dividends_series.tz_localize(None)
 
-    hoje = datetime.now()
-    inicio_periodo = hoje - timedelta(days=years * 365) # Calcula a data de início do período
+    inicio_periodo = HOJE - timedelta(days=years * 365) # Calcula a data de início do período
 
-    # Filtra os dividendos dentro do período desejado
-    dividends_no_periodo = dividends_series[dividends_series.index >= inicio_periodo]
+    # Filtra os dividendos dentro do período desejado (fatia por rótulo: busca binária no índice ordenado por data)
+    dividends_no_periodo = dividends_series.loc[inicio_periodo:]
 
     if dividends_no_periodo.empty:
-        return "N/A" # Nenhum dividendo no período
+        return np.nan # Nenhum dividendo no período
+
+    # Soma os dividendos por ano de uma só vez (índice ordenado pelo ano)
+    dividendos_anuais = dividends_no_periodo.groupby(dividends_no_periodo.index.year).sum()
 
     # Encontra o primeiro e o último ano com dividendos no período
     # Garante que temos pelo menos um ano completo de diferença para calcular CAGR
-    primeiro_ano_com_dividendo = dividends_no_periodo.index.min().year
-    ultimo_ano_com_dividendo = dividends_no_periodo.index.max().year
+    primeiro_ano_com_dividendo = dividendos_anuais.index[0]
+    ultimo_ano_com_dividendo = dividendos_anuais.index[-1]
 
-    # Soma os dividendos do primeiro e último ano com dados
-    total_dividendo_inicio = dividends_no_periodo[dividends_no_periodo.index.year == primeiro_ano_com_dividendo].sum()
-    total_dividendo_fim = dividends_no_periodo[dividends_no_periodo.index.year == ultimo_ano_com_dividendo].sum()
+    # Soma dos dividendos do primeiro e último ano com dados
+    total_dividendo_inicio = dividendos_anuais.iloc[0]
+    total_dividendo_fim = dividendos_anuais.iloc[-1]
 
     # Evita divisão por zero ou log de zero/negativo, ou período muito curto
     if total_dividendo_inicio <= 0 or total_dividendo_fim <= 0 or (ultimo_ano_com_dividendo - primeiro_ano_com_dividendo) < 1:
-        return "N/A"
+        return np.nan
 
     num_periodos = ultimo_ano_com_dividendo - primeiro_ano_com_dividendo
 
     if num_periodos > 0:
         # Fórmula do CAGR: ((Valor Final / Valor Inicial)^(1 / Num Períodos)) - 1
         cagr = ((total_dividendo_fim / total_dividendo_inicio) ** (1 / num_periodos)) - 1
-        return f"{cagr * 100:.2f}%"
+        return cagr * 100
     else:
-        return "N/A" # Apenas um ano de dados no período, não dá pra calcular crescimento
+        return np.nan # Apenas um ano de dados no período, não dá pra calcular crescimento
 
 # --- Carregar dados da carteira ---
 st.subheader("Composição da Carteira")
 dados_carteira = []
-precos_fechamento = pd.DataFrame()
 dividend_yields_dict = {}
 
 with st.spinner("Carregando dados das ações da carteira..."):
+    # Histórico de preços da carteira e do Ibovespa em um único download
+    TICKERS = list(CARTEIRA_ACOES.keys()) + [TICKER_IBOV]
+    try:
+        fechamentos, dividendos_por_ticker = buscar_historico_carteira(tuple(TICKERS), hoje=HOJE)
+    except HistoricoIncompleto as e:
+        st.warning(f"Não foi possível carregar o histórico de preços e dividendos de: {', '.join(e.tickers_com_falha)}. Verifique se os tickers estão corretos.")
+        fechamentos, dividendos_por_ticker = e.historico
+    except Exception as e:
+        st.warning(f"Não foi possível carregar o histórico de preços e dividendos: {e}")
+        fechamentos, dividendos_por_ticker = pd.DataFrame(), {}
+    sem_dividendos = pd.Series(dtype=float, index=pd.DatetimeIndex([])) # Para tickers sem dividendos no download
+
+    # Mantém apenas as ações da carteira que retornaram algum preço (já em float32 desde o download)
+    tickers_com_preco = [t for t in CARTEIRA_ACOES if t in fechamentos.columns and fechamentos[t].notna().any()]
+    precos_fechamento = fechamentos[tickers_com_preco]
+
+    # .info não tem chamada em lote: busca os tickers em paralelo (I/O de rede)
+    # As threads recebem o contexto da execução atual para poderem usar o st.cache_data
+    contexto_execucao = get_script_run_ctx()
+    with ThreadPoolExecutor(
+        max_workers=min(16, len(CARTEIRA_ACOES)),
+        initializer=lambda: add_script_run_ctx(threading.current_thread(), contexto_execucao)
+    ) as executor:
+        resultados = dict(executor.map(buscar_dados_ticker, CARTEIRA_ACOES))
+
     for ticker, atributos in CARTEIRA_ACOES.items():
         try:
-            info, hist, dividends = buscar_dados_acao(ticker)
+            dados_acao, erro = resultados[ticker]
+            if erro is not None:
+                raise erro
+            info = dados_acao
+            dividends = dividendos_por_ticker.get(ticker, sem_dividendos)
             
             # Obtém nome e setor dinamicamente do Yahoo Finance
             nome_acao = info.get('longName', ticker)
             setor_acao = info.get('sector', 'N/A')
-            
-            # Adicionar preço de fechamento ao DataFrame combinado
-            if not hist.empty:
-                precos_fechamento[ticker] = hist['Close']
 
             # Calcular Dividend Yield (últimos 12 meses)
-            hoje = datetime.now()
-            um_ano_atras = hoje - timedelta(days=365)
             if dividends.index.tz is not None:
                 dividends.index = dividends.index.tz_localize(None)
-            # Garantir que a seleção de datas do dividends não falhe se não houver dados no ano
-            dividends_12m = dividends[(dividends.index >= um_ano_atras) & (dividends.index <= hoje)].sum()
+            # Fatia por rótulo no índice já ordenado por data (busca binária nas pontas, sem máscara booleana);
+            # um período sem dividendos resulta em uma fatia vazia, com soma 0
+            dividends_12m = dividends.loc[UM_ANO_ATRAS:HOJE].sum()
             
             current_price = info.get('currentPrice')
+            if not current_price and ticker in precos_fechamento.columns:
+                # Alguns papéis vêm sem 'currentPrice' no .info: usa o último fechamento já baixado em lote
+                ultimo_fechamento = precos_fechamento[ticker].dropna()
+                current_price = float(ultimo_fechamento.iloc[-1]) if not ultimo_fechamento.empty else None
             
             if current_price and current_price > 0:
                 dy = (dividends_12m / current_price) * 100
@@ -174,28 +376,11 @@ with st.spinner("Carregando dados das ações da carteira..."):
 
             # --- NOVAS MÉTRICAS ADICIONADAS AQUI ---
             # Usamos .get() para evitar erros se a métrica não existir para a ação
-            # Formatamos como string para exibir bonito, ou "N/A" se não encontrar
-            pl = info.get('forwardPE', 'N/A') # Preço/Lucro Futuro (mais comum para análise)
-            pvp = info.get('priceToBook', 'N/A') # Preço/Valor Patrimonial
-            roe = info.get('returnOnEquity', 'N/A') # Retorno sobre Patrimônio Líquido
-            market_cap = info.get('marketCap', 'N/A') # Capitalização de Mercado
-            
-            # Formatação para exibição:
-            pl_display = f"{pl:.2f}" if isinstance(pl, (int, float)) else "N/A"
-            pvp_display = f"{pvp:.2f}" if isinstance(pvp, (int, float)) else "N/A"
-            roe_display = f"{roe*100:.2f}%" if isinstance(roe, (int, float)) else "N/A" # ROE geralmente em %
-            
-            # Formatação de Market Cap para bilhões (B) ou milhões (M)
-            market_cap_display = "N/A"
-            if isinstance(market_cap, (int, float)):
-                if market_cap >= 1_000_000_000_000: # Trilhões
-                    market_cap_display = f"R$ {market_cap / 1_000_000_000_000:.2f}T"
-                elif market_cap >= 1_000_000_000: # Bilhões
-                    market_cap_display = f"R$ {market_cap / 1_000_000_000:.2f}B"
-                elif market_cap >= 1_000_000: # Milhões
-                    market_cap_display = f"R$ {market_cap / 1_000_000:.2f}M"
-                else:
-                    market_cap_display = f"R$ {market_cap:,.2f}" # Para valores menores
+            # Os valores ficam numéricos (NaN se não encontrar); a formatação é feita só na exibição
+            pl = _numero(info.get('forwardPE')) # Preço/Lucro Futuro (mais comum para análise)
+            pvp = _numero(info.get('priceToBook')) # Preço/Valor Patrimonial
+            roe = _numero(info.get('returnOnEquity')) * 100 # Retorno sobre Patrimônio Líquido (em %)
+            market_cap = _numero(info.get('marketCap')) / 1_000_000_000 # Capitalização de Mercado (em bilhões)
 
              # --- NOVAS MÉTRICAS DE CRESCIMENTO DE DIVIDENDOS AQUI ---
             # Calcula o crescimento para 3 e 5 anos
@@ -205,14 +390,15 @@ with st.spinner("Carregando dados das ações da carteira..."):
             dados_carteira.append({
                 "Companhia": nome_acao,
                 "Ticker": ticker,
-                "Peso": f"{atributos['peso']*100:.0f}%",
+                "Peso": atributos['peso'] * 100,
+                "Peso_Decimal": atributos['peso'], # Peso numérico, para cálculos
                 "Setor": setor_acao,
-                "Dividend Yield": f"{dy:.2f}%" if current_price else "N/A",
-                "Preço Atual": f"R$ {current_price:.2f}" if current_price else "N/A",
-                "P/L": pl_display,
-                "P/VP": pvp_display,
-                "ROE": roe_display,
-                "Market Cap": market_cap_display,
+                "Dividend Yield": dy if current_price else np.nan,
+                "Preço Atual": current_price if current_price else np.nan,
+                "P/L": pl,
+                "P/VP": pvp,
+                "ROE": roe,
+                "Market Cap (R$ bi)": market_cap,
                 "Cresc. DY (3a)": crescimento_dy_3a, # <-- NOVA COLUNA AQUI
                 "Cresc. DY (5a)": crescimento_dy_5a  # <-- NOVA COLUNA AQUI
             })
@@ -222,60 +408,116 @@ with st.spinner("Carregando dados das ações da carteira..."):
             dados_carteira.append({
                 "Companhia": ticker,
                 "Ticker": ticker,
-                "Peso": f"{atributos['peso']*100:.0f}%",
+                "Peso": atributos['peso'] * 100,
+                "Peso_Decimal": atributos['peso'], # Peso numérico, para cálculos
                 "Setor": "N/A (Erro ao carregar)",
-                "Dividend Yield": "N/A (Erro)",
-                "Preço Atual": "N/A (Erro)",
-                "P/L": "N/A (Erro)",
-                "P/VP": "N/A (Erro)",
-                "ROE": "N/A (Erro)",
-                "Market Cap": "N/A (Erro)",
-                "Cresc. DY (3a)": "N/A (Erro)", # <-- Adicione aqui também!
-                "Cresc. DY (5a)": "N/A (Erro)"  # <-- Adicione aqui também!
+                "Dividend Yield": np.nan,
+                "Preço Atual": np.nan,
+                "P/L": np.nan,
+                "P/VP": np.nan,
+                "ROE": np.nan,
+                "Market Cap (R$ bi)": np.nan,
+                "Cresc. DY (3a)": np.nan, # <-- Adicione aqui também!
+                "Cresc. DY (5a)": np.nan  # <-- Adicione aqui também!
             })
 
 df_carteira = pd.DataFrame(dados_carteira)
+# Setor se repete entre as ações (poucos valores distintos): a categoria guarda códigos inteiros em vez de strings Python.
+# O Ticker fica como texto: sem duplicatas na carteira, cada linha seria uma categoria própria.
+df_carteira = df_carteira.astype({"Setor": "category"})
 df_carteira_sorted = df_carteira.sort_values(by="Companhia").reset_index(drop=True)
-st.dataframe(df_carteira_sorted, use_container_width=True)
+# As colunas são numéricas (serialização Arrow direta); o formato de exibição fica no column_config
+st.dataframe(df_carteira_sorted, use_container_width=True, column_config={
+    "Peso_Decimal": None, # Só para cálculos, não é exibida
+    "Peso": st.column_config.NumberColumn(format="%.0f%%"),
+    "Dividend Yield": st.column_config.NumberColumn(format="%.2f%%"),
+    "Preço Atual": st.column_config.NumberColumn(format="R$ %.2f"),
+    "P/L": st.column_config.NumberColumn(format="%.2f"),
+    "P/VP": st.column_config.NumberColumn(format="%.2f"),
+    "ROE": st.column_config.NumberColumn(format="%.2f%%"),
+    "Market Cap (R$ bi)": st.column_config.NumberColumn(format="R$ %.2f bi"),
+    "Cresc. DY (3a)": st.column_config.NumberColumn(format="%.2f%%"),
+    "Cresc. DY (5a)": st.column_config.NumberColumn(format="%.2f%%"),
+})
+
+# --- Funções que desenham os gráficos do matplotlib ---
+# Ficam em st.cache_data com entradas em tuplas: em uma reexecução com a mesma carteira
+# a imagem PNG já pronta é reaproveitada, sem montar nem rasterizar a figura de novo.
+# O ttl acompanha o dos dados (depois disso as entradas mudam) e max_entries limita a memória no servidor.
+def _pyplot():
+    # Import tardio: só carrega o matplotlib quando há gráfico a desenhar.
+    # O backend 'Agg' (só gera imagens) é fixado antes do pyplot para pular a detecção de backends gráficos no servidor.
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+def _figura_para_png(fig):
+    plt = _pyplot()
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', bbox_inches='tight', dpi=200) # Mesmos parâmetros usados pelo st.pyplot
+    plt.close(fig) # Libera a figura (o pyplot mantém referência a todas as figuras abertas)
+    return buffer.getvalue()
+
+@st.cache_data(ttl=CACHE_TTL_HISTORICO, max_entries=CACHE_MAX_EXPORTS, show_spinner=False)
+def gerar_grafico_setores(setores, pesos):
+    plt = _pyplot()
+    fig_setor, ax_setor = plt.subplots(figsize=(8, 8))
+    
+    # Cria o gráfico de pizza
+    wedges, texts, autotexts = ax_setor.pie(
+        pesos,
+        labels=[f"{s} ({p*100:.1f}%)" for s, p in zip(setores, pesos)], # Exibe setor e %
+        autopct='', # Remove o autopct padrão, pois já colocamos no label
+        startangle=90,
+        pctdistance=0.85 # Distância dos textos de porcentagem do centro
+    )
+    
+    # Ajusta a posição dos textos para evitar sobreposição
+    for autotext in autotexts:
+        autotext.set_color('white') # Cor do texto da porcentagem
+        autotext.set_fontsize(10)
+    
+    ax_setor.set_title("Distribuição da Carteira por Setor")
+    ax_setor.axis('equal')  # Garante que o gráfico de pizza seja circular.
+    return _figura_para_png(fig_setor)
+
+@st.cache_data(ttl=CACHE_TTL_HISTORICO, max_entries=CACHE_MAX_EXPORTS, show_spinner=False)
+def gerar_grafico_dy(tickers, dys):
+    plt = _pyplot()
+    fig_dy, ax_dy = plt.subplots(figsize=(12, 6))
+    
+    # Cria o gráfico de barras
+    bars = ax_dy.bar(tickers, dys, color='teal')
+    
+    ax_dy.set_title("Dividend Yield Individual das Ações na Carteira")
+    ax_dy.set_xlabel("Ticker")
+    ax_dy.set_ylabel("Dividend Yield (%)")
+    ax_dy.grid(axis='y', linestyle='--', alpha=0.7)
+    
+    # Adiciona os valores nas barras para facilitar a leitura
+    for bar in bars:
+        yval = bar.get_height()
+        ax_dy.text(bar.get_x() + bar.get_width()/2, yval + 0.1, f'{yval:.2f}%', ha='center', va='bottom', fontsize=9)
+
+    plt.setp(ax_dy.get_xticklabels(), rotation=45, ha='right') # Rotaciona os rótulos do eixo X para melhor legibilidade
+    fig_dy.tight_layout() # Ajusta o layout para evitar sobreposição
+    return _figura_para_png(fig_dy)
 
 # --- Gráfico de Diversificação Setorial ---
 st.subheader("Diversificação Setorial da Carteira")
 
 if not df_carteira_sorted.empty:
-    # Para o gráfico, precisamos do peso em formato numérico
-    # Use a coluna 'Peso_Decimal' que já criamos para o prompt da IA, se ela estiver disponível
-    # Caso contrário, crie-a aqui
-    if 'Peso_Decimal' not in df_carteira_sorted.columns:
-        df_carteira_sorted['Peso_Decimal'] = df_carteira_sorted['Peso'].str.replace('%', '').astype(float) / 100
-
+    # Para o gráfico, usamos o peso em formato numérico (coluna 'Peso_Decimal')
     # Agrupa por setor e soma os pesos
-    df_setores = df_carteira_sorted.groupby('Setor')['Peso_Decimal'].sum().reset_index()
+    df_setores = df_carteira_sorted.groupby('Setor', observed=True)['Peso_Decimal'].sum().reset_index()
     df_setores.columns = ['Setor', 'Peso Total']
 
     # Filtra setores com peso zero (se houver, para não aparecer no gráfico)
     df_setores = df_setores[df_setores['Peso Total'] > 0]
 
     if not df_setores.empty:
-        fig_setor, ax_setor = plt.subplots(figsize=(8, 8))
-        
-        # Cria o gráfico de pizza
-        wedges, texts, autotexts = ax_setor.pie(
-            df_setores['Peso Total'],
-            labels=[f"{s} ({p*100:.1f}%)" for s, p in zip(df_setores['Setor'], df_setores['Peso Total'])], # Exibe setor e %
-            autopct='', # Remove o autopct padrão, pois já colocamos no label
-            startangle=90,
-            pctdistance=0.85 # Distância dos textos de porcentagem do centro
-        )
-        
-        # Ajusta a posição dos textos para evitar sobreposição
-        for autotext in autotexts:
-            autotext.set_color('white') # Cor do texto da porcentagem
-            autotext.set_fontsize(10)
-        
-        ax_setor.set_title("Distribuição da Carteira por Setor")
-        ax_setor.axis('equal')  # Garante que o gráfico de pizza seja circular.
-        
-        st.pyplot(fig_setor)
+        st.image(gerar_grafico_setores(tuple(df_setores['Setor']), tuple(df_setores['Peso Total'])), use_container_width=True)
     else:
         st.warning("Não foi possível gerar o gráfico de setores. Verifique se há dados de setor válidos.")
 else:
@@ -289,24 +531,7 @@ if dividend_yields_dict: # Verifica se o dicionário de DYs não está vazio
     df_dy_individual = pd.DataFrame(list(dividend_yields_dict.items()), columns=['Ticker', 'Dividend Yield'])
     df_dy_individual = df_dy_individual.sort_values(by='Dividend Yield', ascending=False)
 
-    fig_dy, ax_dy = plt.subplots(figsize=(12, 6))
-    
-    # Cria o gráfico de barras
-    bars = ax_dy.bar(df_dy_individual['Ticker'], df_dy_individual['Dividend Yield'], color='teal')
-    
-    ax_dy.set_title("Dividend Yield Individual das Ações na Carteira")
-    ax_dy.set_xlabel("Ticker")
-    ax_dy.set_ylabel("Dividend Yield (%)")
-    ax_dy.grid(axis='y', linestyle='--', alpha=0.7)
-    
-    # Adiciona os valores nas barras para facilitar a leitura
-    for bar in bars:
-        yval = bar.get_height()
-        ax_dy.text(bar.get_x() + bar.get_width()/2, yval + 0.1, f'{yval:.2f}%', ha='center', va='bottom', fontsize=9)
-
-    plt.xticks(rotation=45, ha='right') # Rotaciona os rótulos do eixo X para melhor legibilidade
-    plt.tight_layout() # Ajusta o layout para evitar sobreposição
-    st.pyplot(fig_dy)
+    st.image(gerar_grafico_dy(tuple(df_dy_individual['Ticker']), tuple(df_dy_individual['Dividend Yield'])), use_container_width=True)
 else:
     st.warning("Não há dados de Dividend Yield individual para gerar o gráfico.")
 
@@ -319,8 +544,7 @@ if not df_carteira.empty:
         peso_ideal_igual = 1.0 / num_acoes # Calcula o peso igual para cada ação
         
         # Cria um DataFrame para a sugestão de rebalanceamento
-        df_rebalanceamento = df_carteira[['Companhia', 'Ticker', 'Peso']].copy()
-        df_rebalanceamento['Peso Atual (%)'] = df_rebalanceamento['Peso'].str.replace('%', '').astype(float)
+        df_rebalanceamento = df_carteira[['Companhia', 'Ticker', 'Peso']].rename(columns={'Peso': 'Peso Atual (%)'}) # 'Peso' já está em %
         df_rebalanceamento['Peso Sugerido (%)'] = peso_ideal_igual * 100
         
         # Calcula a diferença para rebalancear
@@ -336,32 +560,6 @@ if not df_carteira.empty:
             * **Diferença (%) negativa:** Você precisaria **diminuir** a posição nesta ação.
             """
         )
-    else:
-        st.warning("Não há ações na carteira para sugerir um rebalanceamento.")
-else:
-    st.warning("Nenhum dado da carteira disponível para sugerir rebalanceamento.")
-
-    # Continuação do bloco 'Sugestão de Rebalanceamento' (este bloco parece duplicado, mas vou mantê-lo como está no seu original por enquanto)
-if not df_carteira.empty:
-    num_acoes = len(df_carteira)
-    if num_acoes > 0:
-        peso_ideal_igual = 1.0 / num_acoes
-        
-        df_rebalanceamento = df_carteira[['Companhia', 'Ticker', 'Peso']].copy()
-        df_rebalanceamento['Peso Atual (%)'] = df_rebalanceamento['Peso'].str.replace('%', '').astype(float)
-        df_rebalanceamento['Peso Sugerido (%)'] = peso_ideal_igual * 100
-        df_rebalanceamento['Diferença (%)'] = df_rebalanceamento['Peso Sugerido (%)'] - df_rebalanceamento['Peso Atual (%)']
-        
-        st.write("Aqui está uma sugestão de como rebalancear sua carteira para que cada ação tenha um peso igual:")
-        st.dataframe(df_rebalanceamento[['Companhia', 'Ticker', 'Peso Atual (%)', 'Peso Sugerido (%)', 'Diferença (%)']], use_container_width=True)
-
-        st.info(f"**Rebalanceamento para pesos iguais**: Cada uma das {num_acoes} ações teria um peso de {peso_ideal_igual*100:.2f}% na carteira.")
-        st.markdown(
-            """
-            * **Diferença (%) positiva:** Você precisaria **aumentar** a posição nesta ação.
-            * **Diferença (%) negativa:** Você precisaria **diminuir** a posição nesta ação.
-            """
-        )
 
         # --- Ilustração do Máximo Dividend Yield Teórico ---
         st.subheader("Análise de Maximização de Dividend Yield (Teórico)")
@@ -387,43 +585,34 @@ else:
 
 # --- Função para Gerar Prompt da IA ---
 def gerar_prompt_ia(df_carteira, precos_fechamento, dividend_yields_dict):
-    # Formatar os dados da carteira para o prompt da IA
-    carteira_markdown = df_carteira.to_markdown(index=False)
-
-    # Adicionar o Dividend Yield individual no formato do prompt
-    dy_individual_str = "\n".join([f"- {ticker}: {dy:.2f}%" for ticker, dy in dividend_yields_dict.items()])
-
-    # ... (o cálculo do dy_ponderado_final deve vir aqui, como já está no seu código) ...
-    dy_ponderado = 0
-    total_peso = 0
-    # Converta a coluna 'Peso' para float antes de usar, pois ela vem como string "X%"
-    df_temp = df_carteira.copy()
-    df_temp['Peso_Decimal'] = df_temp['Peso'].str.replace('%', '').astype(float) / 100
-
-    for index, row in df_temp.iterrows():
-        ticker = row['Ticker']
-        peso = row['Peso_Decimal']
+    # Formatar os dados da carteira para o prompt da IA: uma linha compacta por ação
+    # (menos tokens que a tabela markdown completa -> resposta mais rápida e mais barata)
+    carteira_str = "\n".join(
+        f"- {companhia} ({ticker}): setor={setor}; peso={peso:.0f}%; DY 12m={_formatar(dy, '{:.2f}%')}; preço={_formatar(preco, 'R$ {:.2f}')}"
+        for companhia, ticker, setor, peso, dy, preco in zip(
+            df_carteira['Companhia'], df_carteira['Ticker'], df_carteira['Setor'],
+            df_carteira['Peso'], df_carteira['Dividend Yield'], df_carteira['Preço Atual']
+        )
+    )
 
-        if ticker in dividend_yields_dict:
-            dy = dividend_yields_dict[ticker]
-            dy_ponderado += dy * peso
-            total_peso += peso
+    # Dividend Yield ponderado pelos pesos, só entre as ações que têm DY calculado
+    tem_dy = df_carteira['Ticker'].isin(dividend_yields_dict.keys()).to_numpy()
+    pesos = df_carteira['Peso_Decimal'].to_numpy(dtype=float)[tem_dy]
+    dys = np.array([dividend_yields_dict[t] for t in df_carteira['Ticker'][tem_dy]], dtype=float)
+    total_peso = pesos.sum()
 
     if total_peso > 0:
-        dy_ponderado_final = dy_ponderado / total_peso
+        dy_ponderado_final = float(dys @ pesos / total_peso)
     else:
         dy_ponderado_final = 0
 
     prompt_content = f"""
     Eu sou um investidor focado em dividendos. Por favor, analise a seguinte carteira de ações e me forneça insights e possíveis sugestões.
 
-    **Data da Análise:** {datetime.now().strftime("%d de %B de %Y")}
+    **Data da Análise:** {HOJE.strftime("%d de %B de %Y")}
 
-    **Composição Atual da Carteira (e seus pesos normalizados):**
-    {carteira_markdown}
-
-    **Dividend Yields Individuais Recentes (últimos 12 meses):**
-    {dy_individual_str}
+    **Composição Atual da Carteira (pesos normalizados e Dividend Yield dos últimos 12 meses):**
+{carteira_str}
 
     **Dividend Yield Ponderado da Carteira:** {dy_ponderado_final:.2f}%
 
@@ -441,6 +630,35 @@ def gerar_prompt_ia(df_carteira, precos_fechamento, dividend_yields_dict):
     """
     return prompt_content
 
+# --- Cache das respostas da IA ---
+# Compartilhado entre sessões e reexecuções: {prompt: (momento da resposta, texto)}.
+# Um dict em st.cache_resource (em vez de st.cache_data) permite continuar exibindo a resposta em streaming;
+# como todas as sessões usam o mesmo dict, ele só é acessado com a trava.
+@st.cache_resource
+def respostas_ia_em_cache():
+    return threading.Lock(), {}
+
+def ler_resposta_ia(prompt):
+    # Retorna o texto guardado para o prompt, ou None se não houver resposta válida
+    trava, respostas = respostas_ia_em_cache()
+    with trava:
+        resposta = respostas.get(prompt)
+    if resposta and datetime.now() - resposta[0] < CACHE_TTL_IA:
+        return resposta[1]
+    return None
+
+def guardar_resposta_ia(prompt, texto):
+    # O dict vive enquanto o servidor estiver no ar: remove as respostas expiradas e limita o tamanho antes de inserir
+    trava, respostas = respostas_ia_em_cache()
+    agora = datetime.now()
+    with trava:
+        for chave in [chave for chave, (momento, _) in respostas.items() if agora - momento >= CACHE_TTL_IA]:
+            del respostas[chave]
+        respostas.pop(prompt, None) # Reinserida no fim, como a mais recente
+        while len(respostas) >= CACHE_MAX_RESPOSTAS_IA:
+            del respostas[next(iter(respostas))] # Dicts mantêm a ordem de inserção: a primeira é a mais antiga
+        respostas[prompt] = (agora, texto)
+
 # --- Análise Automática da Carteira com IA ---
 st.subheader("Análise Automática da Carteira (Gerada por IA)")
 if st.button("Atualizar Análise e Sugestões de IA"): # Botão com novo texto
@@ -448,14 +666,21 @@ if st.button("Atualizar Análise e Sugestões de IA"): # Botão com novo texto
         # Chamar a nova função que gera o prompt
         prompt = gerar_prompt_ia(df_carteira, precos_fechamento, dividend_yields_dict)
         
-        with st.spinner("A IA está gerando a análise e sugestões..."):
-            try:
-                response = model.generate_content(prompt)
-                st.markdown(response.text)
-                st.session_state.ia_report_text = response.text
-            except Exception as e:
-                st.error(f"Erro ao chamar a IA: {e}")
-                st.warning("Verifique sua chave de API e se há limites de uso ou se o modelo está acessível.")
+        resposta_em_cache = ler_resposta_ia(prompt)
+        try:
+            if resposta_em_cache is not None:
+                # Mesma carteira, mesmo dia: reaproveita a análise sem nova chamada (paga) à IA
+                st.markdown(resposta_em_cache)
+                st.session_state.ia_report_text = resposta_em_cache
+            else:
+                with st.spinner("A IA está gerando a análise e sugestões..."):
+                    # stream=True: o texto aparece na tela à medida que a IA gera a resposta
+                    response = model.generate_content(prompt, stream=True)
+                st.session_state.ia_report_text = st.write_stream(chunk.text for chunk in response)
+                guardar_resposta_ia(prompt, st.session_state.ia_report_text)
+        except Exception as e:
+            st.error(f"Erro ao chamar a IA: {e}")
+            st.warning("Verifique sua chave de API e se há limites de uso ou se o modelo está acessível.")
     else:
         st.warning("Nenhum dado da carteira disponível para análise da IA. Faça o upload do arquivo da carteira.")
 
@@ -465,56 +690,62 @@ st.subheader("Desempenho da Carteira vs. Benchmark (Ibovespa)")
 
 if not precos_fechamento.empty:
     with st.spinner("Calculando desempenho da carteira..."):
-        # Buscar dados do Ibovespa
-        info_ibov, hist_ibov, _ = buscar_dados_acao(TICKER_IBOV)
-        
-        # Combinar preços (preencher NaNs com ffill ou bfill para evitar problemas)
-        dados_combinados = pd.concat([precos_fechamento, hist_ibov['Close'].rename(TICKER_IBOV)], axis=1)
-        dados_combinados = dados_combinados.dropna() # Remover datas onde não há dados para todos
-
-        # Normalizar os preços para a base 100
-        dados_normalizados = (dados_combinados / dados_combinados.iloc[0]) * 100
-
-        # Calcular o retorno ponderado da carteira
-        retorno_carteira = pd.Series(0.0, index=dados_normalizados.index)
-        for ticker, atributos in CARTEIRA_ACOES.items():
-            if ticker in dados_normalizados.columns:
-                retorno_carteira += dados_normalizados[ticker] * atributos['peso']
-
-        # Gráfico de Desempenho
-        fig_desempenho, ax_desempenho = plt.subplots(figsize=(12, 6))
-        ax_desempenho.plot(retorno_carteira, label="Carteira Dividendos", color='orange')
-        ax_desempenho.plot(dados_normalizados[TICKER_IBOV], label="Ibovespa", color='blue')
+        # Preços do Ibovespa já vieram no download em lote da carteira
+        tem_ibov = TICKER_IBOV in fechamentos.columns and fechamentos[TICKER_IBOV].notna().any()
+        # A série vazia de reserva usa o mesmo float32 dos preços baixados
+        fechamento_ibov = fechamentos[TICKER_IBOV] if tem_ibov else pd.Series(dtype='float32', name=TICKER_IBOV)
         
-        ax_desempenho.set_title("Desempenho Histórico da Carteira vs. Ibovespa (Base 100)")
-        ax_desempenho.set_xlabel("Data")
-        ax_desempenho.set_ylabel("Retorno (Base 100)")
-        ax_desempenho.legend()
-        ax_desempenho.grid(True)
-        st.pyplot(fig_desempenho)
-
-        # Resumo de retorno (simplificado)
-        if not retorno_carteira.empty:
-            retorno_carteira_total = (retorno_carteira.iloc[-1] / retorno_carteira.iloc[0] - 1) * 100 if retorno_carteira.iloc[0] != 0 else 0
-            retorno_ibov_total = (dados_normalizados[TICKER_IBOV].iloc[-1] / dados_normalizados[TICKER_IBOV].iloc[0] - 1) * 100 if dados_normalizados[TICKER_IBOV].iloc[0] != 0 else 0
-            st.write(f"**Retorno Total da Carteira no período:** {retorno_carteira_total:.2f}%")
-            st.write(f"**Retorno Total do Ibovespa no período:** {retorno_ibov_total:.2f}%")
+        # Combinar preços: o join interno já produz só as datas em comum (sem montar a união completa das datas)
+        dados_combinados = precos_fechamento.join(fechamento_ibov.rename(TICKER_IBOV), how='inner')
+        # Buracos no meio da série (feriados, papéis sem negócio no dia) usam o último fechamento conhecido;
+        # o dropna só remove o início, antes de todos os ativos terem cotação (necessário para a base 100)
+        dados_combinados = dados_combinados.ffill().dropna()
+
+        if dados_combinados.empty:
+            # Sem Ibovespa (ou sem nenhuma data em comum) não há como montar a base 100
+            st.warning("Não há cotações do Ibovespa e da carteira nas mesmas datas para comparar o desempenho.")
+        else:
+            # Normalizar os preços para a base 100
+            dados_normalizados = (dados_combinados / dados_combinados.iloc[0]) * 100
+
+            # Calcular o retorno ponderado da carteira (produto matriz-vetor: preços x pesos)
+            tickers_retorno = [t for t in CARTEIRA_ACOES if t in dados_normalizados.columns]
+            pesos_retorno = np.array([CARTEIRA_ACOES[t]['peso'] for t in tickers_retorno], dtype=np.float32) # Mesmo dtype dos preços: o produto fica todo em float32
+            retorno_carteira = pd.Series(dados_normalizados[tickers_retorno].to_numpy() @ pesos_retorno, index=dados_normalizados.index)
+
+            # Gráfico de Desempenho (renderizado no navegador pelo Vega, sem gerar imagem no servidor)
+            df_desempenho = pd.concat([
+                retorno_carteira.rename("Carteira Dividendos"),
+                dados_normalizados[TICKER_IBOV].rename("Ibovespa")
+            ], axis=1)
+            st.caption("Desempenho Histórico da Carteira vs. Ibovespa (Base 100)")
+            st.line_chart(df_desempenho, x_label="Data", y_label="Retorno (Base 100)", color=["#FFA500", "#0000FF"])
+
+            # Resumo de retorno (simplificado)
+            if not retorno_carteira.empty:
+                retorno_carteira_total = (retorno_carteira.iloc[-1] / retorno_carteira.iloc[0] - 1) * 100 if retorno_carteira.iloc[0] != 0 else 0
+                retorno_ibov_total = (dados_normalizados[TICKER_IBOV].iloc[-1] / dados_normalizados[TICKER_IBOV].iloc[0] - 1) * 100 if dados_normalizados[TICKER_IBOV].iloc[0] != 0 else 0
+                st.write(f"**Retorno Total da Carteira no período:** {retorno_carteira_total:.2f}%")
+                st.write(f"**Retorno Total do Ibovespa no período:** {retorno_ibov_total:.2f}%")
 else:
     st.warning("Não foi possível carregar dados suficientes para calcular o desempenho da carteira.")
 
 # --- Fluxo de Pagamento de Dividendos (Simplificado para o portfólio) ---
 st.subheader("Fluxo de Pagamento de Dividendos da Carteira")
 
-dividendos_combinados = pd.Series(dtype=float)
+dividendos_ponderados = [] # Junta todas as séries e soma uma única vez no final
 with st.spinner("Calculando fluxo de dividendos..."):
-    for ticker in CARTEIRA_ACOES.keys():
-        try:
-            _, _, dividends = buscar_dados_acao(ticker)
-            if not dividends.empty:
-                weighted_dividends = dividends * CARTEIRA_ACOES[ticker]['peso'] 
-                dividendos_combinados = dividendos_combinados.add(weighted_dividends, fill_value=0)
-        except Exception as e:
-            st.warning(f"Erro ao obter dividendos para {ticker}: {e}")
+    # Reaproveita os dividendos já baixados em lote ao carregar a composição da carteira
+    for ticker, atributos in CARTEIRA_ACOES.items():
+        dividends = dividendos_por_ticker.get(ticker, sem_dividendos)
+        if not dividends.empty:
+            dividendos_ponderados.append(dividends * atributos['peso']) # Só exibido na tabela: fica no dtype original
+
+    if dividendos_ponderados:
+        # Soma os dividendos pagos na mesma data por ações diferentes
+        dividendos_combinados = pd.concat(dividendos_ponderados).groupby(level=0).sum().sort_index()
+    else:
+        dividendos_combinados = pd.Series(dtype=float)
 
 if not dividendos_combinados.empty:
     dividendos_combinados_df = dividendos_combinados.to_frame(name='Dividendos Recebidos').reset_index()
@@ -523,20 +754,36 @@ if not dividendos_combinados.empty:
     dividendos_combinados_df = dividendos_combinados_df.sort_values(by='Data', ascending=False)
     st.dataframe(dividendos_combinados_df, use_container_width=True)
 else:
-    st.write("Não há dados de dividendos para esta carteira no período selecionado.")
+    st.write(f"Não há dados de dividendos para esta carteira nos últimos {ANOS_DIVIDENDOS} anos.")
 
 # --- Exportar Dados ---
 # MOVIDO PARA AQUI, DEPOIS DA SEÇÃO DA IA
 st.subheader("Exportar Dados da Carteira")
 
+# Gera o CSV uma única vez por conteúdo da tabela (st.cache_data usa o hash do DataFrame como chave)
+# A tabela muda junto com os dados (a cada 6 horas): mesmo ttl, com limite de entradas
+@st.cache_data(ttl=CACHE_TTL_HISTORICO, max_entries=CACHE_MAX_EXPORTS, show_spinner=False)
+def gerar_csv_carteira(df):
+    # Arquivo para leitura humana: sem a coluna auxiliar de cálculo, valores arredondados e unidades no cabeçalho
+    df_export = df.drop(columns="Peso_Decimal").round(2).rename(columns={
+        "Peso": "Peso (%)",
+        "Dividend Yield": "Dividend Yield (%)",
+        "Preço Atual": "Preço Atual (R$)",
+        "ROE": "ROE (%)",
+        "Cresc. DY (3a)": "Cresc. DY 3a (%)",
+        "Cresc. DY (5a)": "Cresc. DY 5a (%)",
+    })
+    # Usar ; como separador e , como decimal para compatibilidade com Excel BR; bytes evitam nova codificação no download
+    return df_export.to_csv(index=False, sep=';', decimal=',').encode('utf-8')
+
 if not df_carteira.empty:
     # Converte o DataFrame para CSV
-    csv_file = df_carteira_sorted.to_csv(index=False, sep=';', decimal=',') # Usar ; como separador e , como decimal para compatibilidade com Excel BR
+    csv_file = gerar_csv_carteira(df_carteira_sorted)
 
     st.download_button(
         label="Baixar Tabela da Carteira (.csv)",
         data=csv_file,
-        file_name=f"carteira_dividendos_{datetime.now().strftime('%Y%m%d')}.csv",
+        file_name=f"carteira_dividendos_{HOJE.strftime('%Y%m%d')}.csv",
         mime="text/csv",
         help="Baixa a tabela de composição da carteira com todas as métricas em formato CSV."
     )